@@ -3,22 +3,55 @@ import os
 from dotenv import load_dotenv
 load_dotenv()
 
-import json
+import asyncio
+import datetime
+import functools
+import hashlib
+from io import BytesIO
 import logging
-import re
+import mmap
 import html
-import mimetypes
-from typing import List, Optional, Any, Dict
+import time
+from contextlib import asynccontextmanager
+from typing import List, Optional, Any, Dict, Tuple
 from fastapi import FastAPI, HTTPException, status
 from pydantic import BaseModel, HttpUrl
 import uvicorn
-import requests
+import anyio
+import httpx
+import orjson
+from cachetools import TTLCache
+from tenacity import AsyncRetrying, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
 
 # google api core exceptions for nicer error handling
 from google.api_core import exceptions as gexc
 from fastapi.middleware.cors import CORSMiddleware
 
-app = FastAPI(title="LLM Content Validator (Gemini)")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Per-worker startup/shutdown. Runs after fork, so every process owns its own
+    HTTP pool, limiters and (optional) context cache.
+    """
+    global HTTP_CLIENT, _DOWNSCALE_LIMITER
+    # Blocking SDK calls (context cache create) and sync routes share AnyIO's threadpool
+    if ANYIO_THREADS > 0:
+        anyio.to_thread.current_default_thread_limiter().total_tokens = ANYIO_THREADS
+    HTTP_CLIENT = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+        timeout=15.0,
+    )
+    _DOWNSCALE_LIMITER = anyio.CapacityLimiter(os.cpu_count() or 1)
+    if GEMINI_CONTEXT_CACHE:
+        await ensure_prompt_cache()
+    try:
+        yield
+    finally:
+        await HTTP_CLIENT.aclose()
+        HTTP_CLIENT = None
+
+app = FastAPI(title="LLM Content Validator (Gemini)", lifespan=lifespan)
 
 # ✅ Add this right below
 app.add_middleware(
@@ -36,12 +69,47 @@ except Exception:
     genai = None
     _HAS_GENAI = False
 
+# Pillow (or the pillow-simd drop-in) is only used to downscale large images before upload
+try:
+    from PIL import Image, ImageOps
+    _HAS_PIL = True
+except Exception:
+    Image = None
+    ImageOps = None
+    _HAS_PIL = False
+
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger("llm-service")
 
 # --- Configuration from ENV ---
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY", "").strip()
 GEMINI_MODEL = os.environ.get("GEMINI_MODEL", "gemini-2.5-flash")
+# Responses are ~150 tokens, but gemini-2.5+ models think by default and their thinking
+# tokens count against this cap (the SDK cannot set a thinking budget), so only known
+# non-thinking models get the tight default.
+_NON_THINKING_MODEL_PREFIXES = ("gemini-1.5", "gemini-2.0")
+GEMINI_MAX_OUTPUT_TOKENS = int(os.environ.get(
+    "GEMINI_MAX_OUTPUT_TOKENS",
+    256 if GEMINI_MODEL.removeprefix("models/").startswith(_NON_THINKING_MODEL_PREFIXES) else 1024,
+))
+# Explicit context caching is opt-in: the shipped prompt is below the model's minimum
+# cacheable size, and each worker process creates (and pays for) its own cache.
+GEMINI_CONTEXT_CACHE = os.environ.get("GEMINI_CONTEXT_CACHE") == "1"
+GEMINI_CACHE_TTL = int(os.environ.get("GEMINI_CACHE_TTL", 3600))  # seconds
+MAX_IMAGE_BYTES = int(os.environ.get("MAX_IMAGE_BYTES", 10 * 1024 * 1024))
+# images above IMAGE_RESIZE_MIN_BYTES are re-encoded as JPEG with longest edge <= IMAGE_MAX_EDGE
+IMAGE_MAX_EDGE = int(os.environ.get("IMAGE_MAX_EDGE", 1024))
+IMAGE_RESIZE_MIN_BYTES = int(os.environ.get("IMAGE_RESIZE_MIN_BYTES", 200 * 1024))
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", 64))
+VALIDATION_CACHE_SIZE = int(os.environ.get("VALIDATION_CACHE_SIZE", 10_000))
+VALIDATION_CACHE_TTL = int(os.environ.get("VALIDATION_CACHE_TTL", 600))  # seconds
+# per worker process: divide the account-wide RPM by WEB_CONCURRENCY (0 disables pacing)
+GEMINI_CONCURRENCY = int(os.environ.get("GEMINI_CONCURRENCY", 16))
+GEMINI_RPM = int(os.environ.get("GEMINI_RPM", 0))
+# images fetched + buffered at once per worker (each up to MAX_IMAGE_BYTES); bounds /validate_batch fan-out
+IMAGE_FETCH_CONCURRENCY = int(os.environ.get("IMAGE_FETCH_CONCURRENCY", GEMINI_CONCURRENCY))
+# optional override for AnyIO's default threadpool size (40)
+ANYIO_THREADS = int(os.environ.get("ANYIO_THREADS", 0))
 PORT = int(os.environ.get("PORT", 9000))
 HOST = os.environ.get("HOST", "0.0.0.0")
 
@@ -57,22 +125,32 @@ TAG_FILE = os.path.join(os.path.dirname(__file__), "tags.json")
 PREDEFINED_TAGS: List[str] = DEFAULT_TAGS.copy()
 try:
     if os.path.exists(TAG_FILE):
-        with open(TAG_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            if isinstance(data, dict) and "tags" in data and isinstance(data["tags"], list):
-                PREDEFINED_TAGS = [str(t) for t in data["tags"]]
-                log.info("Loaded %d tags from tags.json", len(PREDEFINED_TAGS))
-            elif isinstance(data, list):
-                PREDEFINED_TAGS = [str(t) for t in data]
-                log.info("Loaded %d tags from tags.json (array format)", len(PREDEFINED_TAGS))
-            else:
-                log.warning("tags.json found but has unexpected format; using default tags")
+        # parse straight from a read-only mapping of the file (no intermediate read() copy)
+        with open(TAG_FILE, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            with memoryview(mm) as view:
+                data = orjson.loads(view)
+        if isinstance(data, dict) and "tags" in data and isinstance(data["tags"], list):
+            tags, fmt = data["tags"], ""
+        elif isinstance(data, list):
+            tags, fmt = data, " (array format)"
+        else:
+            tags, fmt = None, ""
+            log.warning("tags.json found but has unexpected format; using default tags")
+        if tags is not None:
+            if not all(isinstance(t, str) for t in tags):
+                raise ValueError("tags.json must contain only strings")
+            PREDEFINED_TAGS = tags
+            log.info("Loaded %d tags from tags.json%s", len(PREDEFINED_TAGS), fmt)
     else:
         log.warning("tags.json not found, using default tags")
 except Exception as e:
     log.exception("Failed to load tags.json; using default tags: %s", e)
     PREDEFINED_TAGS = DEFAULT_TAGS.copy()
 
+PREDEFINED_TAGS_SET = frozenset(PREDEFINED_TAGS)
+# canonical tag list text, joined once; other subsets are memoized by _join_tags
+_CANON_TAGS_STR = ", ".join(PREDEFINED_TAGS)
+
 # Configure Gemini client if SDK available and key present
 GENAI_CONFIGURED = False
 if GEMINI_API_KEY and _HAS_GENAI:
@@ -88,6 +166,9 @@ else:
     if not _HAS_GENAI:
         log.warning("google.generativeai SDK not available. Install 'google-generativeai' to enable LLM checks.")
 
+# Shared async HTTP client (connection pooling + HTTP/2) for image fetches,
+# created in lifespan so each worker process owns its own pool.
+HTTP_CLIENT: Optional[httpx.AsyncClient] = None
 
 
 # --- schemas
@@ -104,93 +185,244 @@ class CheckResponse(BaseModel):
     suggestedTags: List[str]
     raw_llm: Optional[dict] = None
 
+# Gemini response schema mirroring CheckResponse (minus raw_llm) so the model emits
+# JSON server-side instead of free-form text we have to salvage.
+CHECK_SCHEMA: Dict[str, Any] = {
+    "type": "OBJECT",
+    "properties": {
+        "allowed": {"type": "BOOLEAN"},
+        "reason": {"type": "STRING", "nullable": True},
+        "flags": {
+            "type": "OBJECT",
+            "properties": {
+                "inappropriate": {"type": "BOOLEAN"},
+                "spam": {"type": "BOOLEAN"},
+                "advertisement": {"type": "BOOLEAN"},
+                "mismatch": {"type": "BOOLEAN"},
+            },
+            "required": ["inappropriate", "spam", "advertisement", "mismatch"],
+        },
+        "suggestedTags": {
+            "type": "ARRAY",
+            "items": {"type": "STRING", "format": "enum", "enum": PREDEFINED_TAGS},
+        },
+    },
+    "required": ["allowed", "flags", "suggestedTags"],
+}
+
+GENERATION_CONFIG: Dict[str, Any] = {
+    "temperature": 0.0,
+    "max_output_tokens": GEMINI_MAX_OUTPUT_TOKENS,
+    "candidate_count": 1,
+    "response_mime_type": "application/json",
+    "response_schema": CHECK_SCHEMA,
+}
+
 # --- helpers
-def build_prompt(description: str, image_url: Optional[str], allowed_tags: List[str]) -> str:
+SYSTEM_TEXT = (
+    "You are a strict content-moderation-and-categorization assistant. "
+    "When given an image (accessible via the provided URL) and a text description, you MUST return "
+    "ONLY a single JSON object (no surrounding commentary, no markdown, nothing but JSON). "
+    "The JSON must match EXACTLY this schema:\n"
+    '{\n'
+    '  "allowed": boolean,          # true if content is allowed to post\n'
+    '  "reason": string|null,       # short reason when blocked\n'
+    '  "flags": {                   # booleans for categories\n'
+    '      "inappropriate": boolean,\n'
+    '      "spam": boolean,\n'
+    '      "advertisement": boolean,\n'
+    '      "mismatch": boolean\n'
+    '  },\n'
+    '  "suggestedTags": [string...]  # list of tags from the allowed tags list\n'
+    '}\n\n'
+    "Rules:\n"
+    "1) If any of inappropriate/spam/advertisement is true, set allowed=false and provide reason.\n"
+    "2) If mismatch is true (image clearly does not match the description), set allowed=false and provide reason.\n"
+    "3) suggestedTags MUST be a subset of the allowed tags provided below; DO NOT invent new tags.\n"
+    "4) If uncertain, set allowed=false and reason='uncertain'.\n"
+    "5) Keep reason under 20 words.\n"
+    "Output compact JSON on a single line, no newlines or indentation. "
+    "Return JSON only and nothing else."
+)
+
+@functools.lru_cache(maxsize=1024)
+def _join_tags(tags: Tuple[str, ...]) -> str:
+    return ", ".join(tags)
+
+def _tag_list_text(allowed_tags: List[str]) -> str:
+    if not allowed_tags:
+        return "no tags provided"
+    if allowed_tags is PREDEFINED_TAGS:
+        return _CANON_TAGS_STR
+    return _join_tags(tuple(allowed_tags))
+
+def build_user_prompt(description: str, image_url: Optional[str], allowed_tags: Optional[List[str]]) -> str:
     """
-    Return system+user combined prompt instructing model to return strict JSON only.
+    Return the per-request user prompt. Pass allowed_tags=None when the tag list
+    already lives in the Gemini context cache.
     """
-    tag_list_text = ", ".join(allowed_tags) if allowed_tags else "no tags provided"
-
-    system = (
-        "You are a strict content-moderation-and-categorization assistant. "
-        "When given an image (accessible via the provided URL) and a text description, you MUST return "
-        "ONLY a single JSON object (no surrounding commentary, no markdown, nothing but JSON). "
-        "The JSON must match EXACTLY this schema:\n"
-        '{\n'
-        '  "allowed": boolean,          # true if content is allowed to post\n'
-        '  "reason": string|null,       # short reason when blocked\n'
-        '  "flags": {                   # booleans for categories\n'
-        '      "inappropriate": boolean,\n'
-        '      "spam": boolean,\n'
-        '      "advertisement": boolean,\n'
-        '      "mismatch": boolean\n'
-        '  },\n'
-        '  "suggestedTags": [string...]  # list of tags from the allowed tags list\n'
-        '}\n\n'
-        "Rules:\n"
-        "1) If any of inappropriate/spam/advertisement is true, set allowed=false and provide reason.\n"
-        "2) If mismatch is true (image clearly does not match the description), set allowed=false and provide reason.\n"
-        "3) suggestedTags MUST be a subset of the allowed tags provided below; DO NOT invent new tags.\n"
-        "4) If uncertain, set allowed=false and reason='uncertain'.\n"
-        "Return JSON only and nothing else."
+    user = f"IMAGE_URL: {image_url or 'NONE'}\n\nDESCRIPTION: \"\"\"{description}\"\"\"\n\n"
+    if allowed_tags is not None:
+        user += f"ALLOWED_TAGS: {_tag_list_text(allowed_tags)}\n\n"
+    return user + "Return the JSON object exactly as described above."
+
+# Shared model instance built once with the system prompt (no per-request constructor cost)
+MODEL: Any = None
+if GENAI_CONFIGURED:
+    try:
+        MODEL = genai.GenerativeModel(GEMINI_MODEL, system_instruction=SYSTEM_TEXT)
+    except Exception as e:
+        log.exception("Failed to create Gemini model %s: %s", GEMINI_MODEL, e)
+        GENAI_CONFIGURED = False
+
+# --- Gemini call pacing: bounded concurrency + leaky-bucket spacing + 429 backoff
+class _RateLimiter:
+    """Leaky bucket spacing calls at least 60/rpm seconds apart."""
+
+    def __init__(self, rpm: int):
+        self.interval = 60.0 / rpm if rpm > 0 else 0.0
+        self._next_slot = 0.0
+
+    async def acquire(self) -> None:
+        if not self.interval:
+            return
+        now = time.monotonic()
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+GEMINI_SEM = asyncio.Semaphore(GEMINI_CONCURRENCY)
+GEMINI_RATE = _RateLimiter(GEMINI_RPM)
+
+async def generate_content(model: Any, parts: List[Any]) -> Any:
+    """generate_content_async under GEMINI_SEM/GEMINI_RATE, retrying 429s with jittered backoff."""
+    async for attempt in AsyncRetrying(
+        retry=retry_if_exception_type(gexc.ResourceExhausted),
+        wait=wait_exponential_jitter(initial=0.5, max=8),
+        stop=stop_after_attempt(4),
+        reraise=True,
+    ):
+        with attempt:
+            async with GEMINI_SEM:
+                await GEMINI_RATE.acquire()
+                return await model.generate_content_async(parts, generation_config=GENERATION_CONFIG)
+
+# --- Gemini context cache (system prompt + canonical tag list, created once and refreshed before TTL)
+_CACHED_MODEL: Any = None
+_PROMPT_CACHE_EXPIRES_AT = 0.0
+_PROMPT_CACHE_RETRY_AT = 0.0
+_PROMPT_CACHE_DISABLED = not GEMINI_CONTEXT_CACHE
+_PROMPT_CACHE_LOCK = asyncio.Lock()
+
+def _create_cached_model() -> Any:
+    cache = genai.caching.CachedContent.create(
+        model=GEMINI_MODEL,
+        system_instruction=SYSTEM_TEXT,
+        contents=[f"ALLOWED_TAGS: {_CANON_TAGS_STR}"],
+        ttl=datetime.timedelta(seconds=GEMINI_CACHE_TTL),
     )
+    log.info("Created Gemini context cache %s (ttl=%ss)", getattr(cache, "name", "?"), GEMINI_CACHE_TTL)
+    return genai.GenerativeModel.from_cached_content(cached_content=cache)
 
-    user = f"IMAGE_URL: {image_url or 'NONE'}\n\nDESCRIPTION: \"\"\"{description}\"\"\"\n\nALLOWED_TAGS: {tag_list_text}\n\nReturn the JSON object exactly as described above."
-
-    return f"{system}\n\n{user}"
+async def ensure_prompt_cache() -> Any:
+    """
+    Return a shared GenerativeModel bound to a live context cache for the canonical prompt,
+    or None if context caching is disabled or unavailable. Transient failures back off for
+    5 minutes; InvalidArgument (e.g. prompt below the model's minimum cacheable size) disables
+    caching for the life of the process. Either way requests fall back to MODEL.
+    """
+    global _CACHED_MODEL, _PROMPT_CACHE_EXPIRES_AT, _PROMPT_CACHE_RETRY_AT, _PROMPT_CACHE_DISABLED
+    if _PROMPT_CACHE_DISABLED or not GENAI_CONFIGURED:
+        return None
+    if _CACHED_MODEL is not None and time.monotonic() < _PROMPT_CACHE_EXPIRES_AT:
+        return _CACHED_MODEL
+    if time.monotonic() < _PROMPT_CACHE_RETRY_AT:
+        return None
+
+    async with _PROMPT_CACHE_LOCK:
+        now = time.monotonic()
+        if _CACHED_MODEL is not None and now < _PROMPT_CACHE_EXPIRES_AT:
+            return _CACHED_MODEL
+        if _PROMPT_CACHE_DISABLED or now < _PROMPT_CACHE_RETRY_AT:
+            return None
+        try:
+            cached_model = await anyio.to_thread.run_sync(_create_cached_model)
+        except gexc.InvalidArgument as e:
+            log.warning("Gemini context cache rejected; disabling it for this process: %s", e)
+            _CACHED_MODEL = None
+            _PROMPT_CACHE_DISABLED = True
+            return None
+        except Exception as e:
+            log.warning("Gemini context cache unavailable; sending full prompt instead: %s", e)
+            _CACHED_MODEL = None
+            _PROMPT_CACHE_RETRY_AT = now + 300
+            return None
+        _CACHED_MODEL = cached_model
+        # refresh a minute before the server-side TTL lapses
+        _PROMPT_CACHE_EXPIRES_AT = now + max(GEMINI_CACHE_TTL - 60, 0)
+        return cached_model
 
 def extract_text_from_response(response: Any) -> str:
     """
-    Safely extract a textual payload from various SDK response shapes.
+    Return the text of the first candidate's first part (google-generativeai>=0.8 shape).
     Avoid using response.text accessor directly because it may raise.
-    Return a string (may be long) which should include the JSON object.
     """
-    # 1) candidates
-    try:
-        cands = getattr(response, "candidates", None)
-        if cands and isinstance(cands, (list, tuple)) and len(cands) > 0:
-            cand0 = cands[0]
-            # candidate may be object or dict
-            txt = getattr(cand0, "text", None) or (cand0.get("text") if isinstance(cand0, dict) else None)
-            if txt:
-                return txt
-    except Exception:
-        pass
-
-    # 2) outputs -> content
-    try:
-        outputs = getattr(response, "outputs", None)
-        if outputs and isinstance(outputs, (list, tuple)) and len(outputs) > 0:
-            out0 = outputs[0]
-            content = getattr(out0, "content", None) or (out0.get("content") if isinstance(out0, dict) else None)
-            if isinstance(content, (list, tuple)) and content:
-                # search for first text-like entry
-                for part in content:
-                    if isinstance(part, dict):
-                        for key in ("text", "plain_text", "content"):
-                            if key in part and isinstance(part[key], str) and part[key].strip():
-                                return part[key]
-                    else:
-                        txt = getattr(part, "text", None) or getattr(part, "plain_text", None)
-                        if txt and isinstance(txt, str) and txt.strip():
-                            return txt
-            # fall back to stringifying the output element
-            return str(out0)
-    except Exception:
-        pass
-
-    # 3) response.response or response.output
+    cands = response.candidates
+    if not cands:
+        raise ValueError(f"Gemini returned no candidates (prompt_feedback: {response.prompt_feedback})")
+    parts = cands[0].content.parts
+    if not parts:
+        raise ValueError(f"Gemini candidate has no content (finish_reason: {cands[0].finish_reason})")
+    return parts[0].text
+
+def _find_json_span(s: str) -> Optional[Tuple[int, int]]:
+    """
+    Single linear scan for the first top-level {...} object, tracking string-literal
+    and escape state so braces inside strings are ignored. Returns (start, end) or None.
+    """
+    start = s.find("{")
+    if start < 0:
+        return None
+    depth = 0
+    in_string = False
+    escape = False
+    for i in range(start, len(s)):
+        c = s[i]
+        if in_string:
+            if escape:
+                escape = False
+            elif c == "\\":
+                escape = True
+            elif c == '"':
+                in_string = False
+        elif c == '"':
+            in_string = True
+        elif c == "{":
+            depth += 1
+        elif c == "}":
+            depth -= 1
+            if depth == 0:
+                return start, i + 1
+    return None
+
+def _loads_object(s: str) -> Optional[Dict[str, Any]]:
+    """orjson.loads the whole string, then the first top-level object in it; None if neither yields a dict."""
     try:
-        maybe = getattr(response, "response", None) or getattr(response, "output", None)
-        if maybe:
-            s = str(maybe)
-            if s and len(s) > 0:
-                return s
+        parsed = orjson.loads(s)
+        if isinstance(parsed, dict):
+            return parsed
     except Exception:
         pass
-
-    # 4) as last resort, stringify the whole response
-    return str(response)
+    span = _find_json_span(s)
+    if span:
+        try:
+            parsed = orjson.loads(s[span[0]:span[1]])
+            if isinstance(parsed, dict):
+                return parsed
+        except Exception:
+            pass
+    return None
 
 def clean_model_text_and_extract_json(text: str) -> Dict[str, Any]:
     """
@@ -202,60 +434,131 @@ def clean_model_text_and_extract_json(text: str) -> Dict[str, Any]:
     if not text or not isinstance(text, str):
         raise ValueError("Empty or non-string model output")
 
-    s = text.strip()
+    # 1) strip fenced code block markers if present (plain string ops, no regex)
+    s = text.strip().removeprefix("```json").removeprefix("```JSON").removeprefix("```").removesuffix("```").strip()
 
-    # 1) extract fenced code block content if present
-    fence_re = re.search(r"```(?:json)?\s*([\s\S]*?)\s*```", s, re.IGNORECASE)
-    if fence_re:
-        s = fence_re.group(1).strip()
-
-    # 2) some model outputs contain escaped JSON e.g. "\"{\\n  \\\"a\\\":1\\n}\""
-    # Try to unescape common escape sequences if they appear to exist.
-    try:
-        if r'\"' in s or r'\\n' in s or r'\\\"' in s:
-            s_unescaped = s.encode('utf-8').decode('unicode_escape')
-            # Trim surrounding quotes if present
-            if s_unescaped.startswith('"') and s_unescaped.endswith('"'):
-                s_unescaped = s_unescaped[1:-1]
-            s = s_unescaped
-    except Exception:
-        # If unescape fails, keep original s
-        pass
+    # 2) direct parse, or the first top-level { ... } object
+    parsed = _loads_object(s)
+    if parsed is not None:
+        return parsed
 
-    # 3) Try direct json.loads
+    # 3) some model outputs contain escaped JSON e.g. "\"{\\n  \\\"a\\\":1\\n}\""
+    # Only now pay for the unicode_escape round-trip.
     try:
-        return json.loads(s)
+        s_unescaped = s.encode('utf-8').decode('unicode_escape')
+        # Trim surrounding quotes if present
+        if s_unescaped.startswith('"') and s_unescaped.endswith('"'):
+            s_unescaped = s_unescaped[1:-1]
+        parsed = _loads_object(s_unescaped)
+        if parsed is not None:
+            return parsed
     except Exception:
-        pass
+        s_unescaped = s
 
-    # 4) Extract first { ... } block and try again
-    m = re.search(r"(\{(?:[\s\S]*?)\})", s)
-    if m:
-        candidate = m.group(1)
-        candidate_clean = candidate
-        try:
-            candidate_clean = candidate.encode('utf-8').decode('unicode_escape')
-        except Exception:
-            pass
-        try:
-            return json.loads(candidate_clean)
-        except Exception:
-            # try HTML unescape
-            try:
-                return json.loads(html.unescape(candidate_clean))
-            except Exception as e:
-                raise ValueError(f"Failed to parse JSON candidate: {e}")
+    # 4) try HTML unescape
+    parsed = _loads_object(html.unescape(s_unescaped))
+    if parsed is not None:
+        return parsed
 
     raise ValueError("Unable to extract JSON object from model output")
 
-def guess_mime_from_url(url: str) -> str:
-    if not url:
+def sniff_image_mime(head: bytes) -> str:
+    """
+    Detect common image formats from their magic bytes (signed URLs often have no
+    extension to guess from). Falls back to image/jpeg.
+    """
+    if head[:3] == b"\xff\xd8\xff":
         return "image/jpeg"
-    mime, _ = mimetypes.guess_type(url)
-    if mime and mime.startswith("image/"):
-        return mime
+    if head[:8] == b"\x89PNG\r\n\x1a\n":
+        return "image/png"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
     return "image/jpeg"
 
+async def fetch_image(url: str) -> Tuple[bytes, str]:
+    """
+    Stream an image from url, rejecting it with 413 as soon as it is known to exceed
+    MAX_IMAGE_BYTES (declared Content-Length or bytes received). Returns (bytes, mime).
+    """
+    chunks: List[bytes] = []
+    received = 0
+    async with HTTP_CLIENT.stream("GET", url) as r:
+        r.raise_for_status()
+        declared = r.headers.get("content-length")
+        if declared and declared.isdigit() and int(declared) > MAX_IMAGE_BYTES:
+            raise HTTPException(status_code=413, detail="Image too large for validation")
+        async for chunk in r.aiter_bytes():
+            received += len(chunk)
+            if received > MAX_IMAGE_BYTES:
+                raise HTTPException(status_code=413, detail="Image too large for validation")
+            chunks.append(chunk)
+    img_bytes = chunks[0] if len(chunks) == 1 else b"".join(chunks)
+    return img_bytes, sniff_image_mime(img_bytes[:12])
+
+def downscale_image(img_bytes: bytes, mime: str) -> Tuple[bytes, str]:
+    """
+    Shrink an image to IMAGE_MAX_EDGE on its longest side and re-encode as JPEG q=85.
+    Gemini resizes internally anyway, so this only cuts upload bytes. Returns the input
+    unchanged when it is already small enough.
+    """
+    with Image.open(BytesIO(img_bytes)) as im:
+        if max(im.size) <= IMAGE_MAX_EDGE:
+            return img_bytes, mime
+        # let the JPEG decoder skip straight to a reduced scale
+        im.draft("RGB", (IMAGE_MAX_EDGE, IMAGE_MAX_EDGE))
+        # re-encoding drops EXIF, so bake the Orientation tag into the pixels first
+        oriented = ImageOps.exif_transpose(im)
+        oriented.thumbnail((IMAGE_MAX_EDGE, IMAGE_MAX_EDGE), Image.LANCZOS)
+        buf = BytesIO()
+        oriented.convert("RGB").save(buf, "JPEG", quality=85, optimize=True)
+    return buf.getvalue(), "image/jpeg"
+
+# Decodes are CPU- and memory-heavy, so they get their own pool of cpu_count slots instead
+# of the shared AnyIO threadpool (created in lifespan: a limiter needs a running event loop).
+_DOWNSCALE_LIMITER: Optional[anyio.CapacityLimiter] = None
+
+IMAGE_FETCH_SEM = asyncio.Semaphore(IMAGE_FETCH_CONCURRENCY)
+
+async def fetch_validation_image(url: Optional[str]) -> Optional[Tuple[bytes, str]]:
+    """
+    fetch_image for /validate: None when there is no URL, fetch failures mapped to 400,
+    large images downscaled (off the event loop) before they are sent to Gemini.
+    At most IMAGE_FETCH_CONCURRENCY fetch+downscale steps run at once.
+    """
+    if not url:
+        return None
+    async with IMAGE_FETCH_SEM:
+        try:
+            img_bytes, mime = await fetch_image(url)
+        except HTTPException:
+            raise
+        except Exception as e:
+            log.exception("Failed to fetch image bytes: %s", e)
+            raise HTTPException(status_code=400, detail="Could not fetch image for validation")
+
+        # GIFs are left alone so animations are not flattened to one frame
+        if _HAS_PIL and len(img_bytes) >= IMAGE_RESIZE_MIN_BYTES and mime != "image/gif":
+            try:
+                img_bytes, mime = await anyio.to_thread.run_sync(downscale_image, img_bytes, mime, limiter=_DOWNSCALE_LIMITER)
+            except Exception as e:
+                log.warning("Could not downscale image, sending original: %s", e)
+    return img_bytes, mime
+
+# --- validation result cache (duplicate submissions / client retries skip Gemini entirely).
+# Only touched from the event loop thread with no await between get and set, so no lock is needed.
+_VCACHE: TTLCache = TTLCache(maxsize=VALIDATION_CACHE_SIZE, ttl=VALIDATION_CACHE_TTL)
+
+def validation_cache_key(description: str, image_url: Optional[str], allowed_tags: List[str]) -> bytes:
+    # each field is length-prefixed so no description/URL split can collide with another
+    h = hashlib.blake2b(digest_size=16)
+    for field in (description, image_url or "", _tag_list_text(allowed_tags)):
+        data = field.encode("utf-8")
+        h.update(len(data).to_bytes(4, "big"))
+        h.update(data)
+    return h.digest()
+
 # --- routes
 @app.get("/health")
 def health():
@@ -271,86 +574,106 @@ def health():
 def get_tags():
     return {"tags": PREDEFINED_TAGS, "count": len(PREDEFINED_TAGS)}
 
-@app.post("/validate", response_model=CheckResponse)
-async def validate(req: CheckRequest):
-    """
-    Validate description + image and return structured JSON:
-    { allowed, reason, flags, suggestedTags }
-    """
+def _require_genai():
     if not GENAI_CONFIGURED:
         log.error("LLM check attempted but Gemini not configured or SDK missing.")
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                             detail="LLM backend not configured. Set GEMINI_API_KEY and install google-generativeai.")
 
-    # Normalize allowed tags (server canonical)
-    allowed_tags: List[str] = [t for t in (req.allowedTags or PREDEFINED_TAGS) if t in PREDEFINED_TAGS]
-    if not allowed_tags:
-        allowed_tags = PREDEFINED_TAGS
+@app.post("/validate", response_model=CheckResponse, response_model_exclude_unset=True)
+async def validate(req: CheckRequest, debug: bool = False):
+    """
+    Validate description + image and return structured JSON:
+    { allowed, reason, flags, suggestedTags }
+    With ?debug=1 the (truncated) raw model output is included as raw_llm.
+    """
+    _require_genai()
+    return await validate_one(req, debug)
 
-    # Build prompt (strict JSON-only)
-    prompt = build_prompt(req.description or "", str(req.imageUrl) if req.imageUrl else None, allowed_tags)
+@app.post("/validate_batch", response_model=List[CheckResponse], response_model_exclude_unset=True)
+async def validate_batch(reqs: List[CheckRequest]):
+    """
+    Validate up to MAX_BATCH_SIZE items concurrently (Gemini calls still share GEMINI_SEM).
+    Results are returned in request order; an item that fails comes back as
+    allowed=false with reason "error: ..." instead of failing the whole batch.
+    """
+    _require_genai()
+    if len(reqs) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=413, detail=f"Batch too large (max {MAX_BATCH_SIZE} items)")
 
-    # Build parts array (image bytes + text)
-    parts = []
-    if req.imageUrl:
-        # fetch image bytes
+    async def run(req: CheckRequest) -> Dict[str, Any]:
         try:
-            r = requests.get(str(req.imageUrl), timeout=15)
-            r.raise_for_status()
-            img_bytes = r.content
-            mime = guess_mime_from_url(str(req.imageUrl))
+            return await validate_one(req)
+        except HTTPException as e:
+            reason = e.detail
         except Exception as e:
-            log.exception("Failed to fetch image bytes: %s", e)
-            raise HTTPException(status_code=400, detail="Could not fetch image for validation")
+            log.exception("Batch item validation failed: %s", e)
+            reason = str(e)
+        return {
+            "allowed": False,
+            "reason": f"error: {reason}",
+            "flags": {"inappropriate": False, "spam": False, "advertisement": False, "mismatch": False},
+            "suggestedTags": [],
+        }
 
-        # Try to create a Part from SDK types if available
-        part_obj = None
-        try:
-            types_mod = getattr(genai, "types", None)
-            if types_mod and hasattr(types_mod, "Part") and hasattr(types_mod.Part, "from_bytes"):
-                part_obj = types_mod.Part.from_bytes(data=img_bytes, mime_type=mime)
-            else:
-                try:
-                    from google.generativeai import types as genai_types  # type: ignore
-                    if hasattr(genai_types, "Part") and hasattr(genai_types.Part, "from_bytes"):
-                        part_obj = genai_types.Part.from_bytes(data=img_bytes, mime_type=mime)
-                except Exception:
-                    part_obj = None
-        except Exception:
-            part_obj = None
+    return await asyncio.gather(*(run(r) for r in reqs))
 
-        if part_obj is not None:
-            parts.append(part_obj)
-        else:
-            # fallback to dict with raw bytes (some SDK versions accept this)
-            parts.append({"mime_type": mime, "data": img_bytes})
+async def validate_one(req: CheckRequest, debug: bool = False) -> Dict[str, Any]:
+    """Shared /validate and /validate_batch implementation; raises HTTPException on failure."""
+    # Normalize allowed tags (server canonical)
+    # (reuse the PREDEFINED_TAGS object itself when no subset is requested so the
+    # prompt builder can take the pre-joined fast path)
+    allowed_tags: List[str] = [t for t in req.allowedTags if t in PREDEFINED_TAGS_SET] if req.allowedTags else PREDEFINED_TAGS
+    if not allowed_tags:
+        allowed_tags = PREDEFINED_TAGS
+    allowed_set = PREDEFINED_TAGS_SET if allowed_tags is PREDEFINED_TAGS else frozenset(allowed_tags)
+
+    image_url = str(req.imageUrl) if req.imageUrl else None
+    cache_key = validation_cache_key(req.description or "", image_url, allowed_tags)
+    # debug requests always hit the model so raw_llm reflects a real response
+    cached = None if debug else _VCACHE.get(cache_key)
+    if cached is not None:
+        return cached
+
+    # Fetch the image and (if needed) create/refresh the context cache concurrently;
+    # both are network round-trips. The canonical tag set is served from the Gemini
+    # context cache, so only the per-request part of the prompt is sent.
+    image, model = await asyncio.gather(
+        fetch_validation_image(image_url),
+        # asyncio.sleep(0) resolves to None -> fall back to MODEL with the inline tag list
+        ensure_prompt_cache() if GEMINI_CONTEXT_CACHE and allowed_set == PREDEFINED_TAGS_SET else asyncio.sleep(0),
+    )
+    if model is not None:
+        prompt = build_user_prompt(req.description or "", image_url, None)
+    else:
+        model = MODEL
+        prompt = build_user_prompt(req.description or "", image_url, allowed_tags)
+
+    # Build parts array (image bytes + text)
+    parts = []
+    if image is not None:
+        img_bytes, mime = image
+        parts.append({"mime_type": mime, "data": img_bytes})
 
     # Add textual prompt as a text part
     parts.append({"text": prompt})
 
     try:
-        # Ensure model object present
-        if not hasattr(genai, "GenerativeModel"):
-            raise RuntimeError("google-generativeai SDK does not expose GenerativeModel. Upgrade package.")
-
-        model = genai.GenerativeModel(GEMINI_MODEL)
-
-        # Call generate_content with stable params
-        try:
-            resp = model.generate_content(parts, generation_config={"temperature": 0.0, "max_output_tokens": 1024})
-        except TypeError:
-            # alternative signature fallback
-            resp = model.generate_content(parts, temperature=0.0, max_output_tokens=1024)
+        # Await the async SDK call so the Gemini round-trip does not block the event loop
+        resp = await generate_content(model, parts)
 
         # Extract text safely (do NOT use resp.text accessor directly)
         text_out = extract_text_from_response(resp)
 
-        # Clean & parse JSON using robust extractor
+        # Output is schema-constrained JSON; keep the robust extractor only as an emergency fallback
         try:
-            parsed_json = clean_model_text_and_extract_json(text_out)
-        except Exception as e:
-            log.exception("Failed to extract JSON from model output: %s", e)
-            raise HTTPException(status_code=500, detail=f"LLM returned non-JSON output. Raw (truncated): {str(text_out)[:1000]}")
+            parsed_json = orjson.loads(text_out)
+        except Exception:
+            try:
+                parsed_json = clean_model_text_and_extract_json(text_out)
+            except Exception as e:
+                log.exception("Failed to extract JSON from model output: %s", e)
+                raise HTTPException(status_code=500, detail=f"LLM returned non-JSON output. Raw (truncated): {str(text_out)[:1000]}")
 
         # Validate parsed_json conforms to expected keys and types
         if not isinstance(parsed_json, dict):
@@ -367,7 +690,7 @@ async def validate(req: CheckRequest):
             suggested_raw = []
 
         # enforce suggested tags to be subset of allowed_tags
-        suggested_tags = [t for t in suggested_raw if isinstance(t, str) and t in allowed_tags]
+        suggested_tags = [t for t in suggested_raw if isinstance(t, str) and t in allowed_set]
 
         # sanitize flags
         flags = {
@@ -377,13 +700,16 @@ async def validate(req: CheckRequest):
             "mismatch": bool(flags_val.get("mismatch", False))
         }
 
-        return {
+        result = {
             "allowed": allowed_val,
             "reason": reason_val,
             "flags": flags,
             "suggestedTags": suggested_tags,
-            "raw_llm": {"raw": str(text_out)[:4000]}
         }
+        _VCACHE[cache_key] = result
+        if debug:
+            return {**result, "raw_llm": {"raw": str(text_out)[:4000]}}
+        return result
 
     except gexc.GoogleAPIError as api_err:
         log.exception("Gemini API error: %s", api_err)
@@ -398,6 +724,11 @@ async def validate(req: CheckRequest):
 if __name__ == "__main__":
     if not GEMINI_API_KEY:
         log.warning("GEMINI_API_KEY not set in environment when starting app directly.")
-    log.info("Starting uvicorn server on %s:%s (GENAI configured=%s) — tags loaded: %d",
-             HOST, PORT, GENAI_CONFIGURED, len(PREDEFINED_TAGS))
-    uvicorn.run("app:app", host=HOST, port=PORT, reload=True)
+    # DEV=1 enables the autoreloader (single worker); otherwise run production workers,
+    # sized the same way as under gunicorn (WEB_CONCURRENCY or 2*CPU+1)
+    from gunicorn_conf import workers as production_workers
+    reload = os.environ.get("DEV") == "1"
+    workers = 1 if reload else production_workers
+    log.info("Starting uvicorn server on %s:%s (GENAI configured=%s, workers=%d, reload=%s) — tags loaded: %d",
+             HOST, PORT, GENAI_CONFIGURED, workers, reload, len(PREDEFINED_TAGS))
+    uvicorn.run("app:app", host=HOST, port=PORT, reload=reload, workers=workers, loop="auto", http="auto")
@@ -0,0 +1,14 @@
+# gunicorn_conf.py
+# Production entrypoint:  gunicorn -c gunicorn_conf.py app:app
+import os
+
+bind = f"{os.environ.get('HOST', '0.0.0.0')}:{os.environ.get('PORT', 9000)}"
+workers = int(os.environ.get("WEB_CONCURRENCY", (os.cpu_count() or 1) * 2 + 1))
+# UvicornWorker picks uvloop + httptools automatically when they are installed
+worker_class = "uvicorn.workers.UvicornWorker"
+keepalive = 5
+timeout = 60
+
+# Import app.py in each worker after fork (no preload) so the HTTP client, Gemini
+# client configuration and context cache are owned per process.
+preload_app = False
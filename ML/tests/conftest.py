@@ -0,0 +1,5 @@
+import os
+import sys
+
+# app.py lives in ML/, one level up from the tests
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
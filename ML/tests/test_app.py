@@ -0,0 +1,109 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+from pydantic import TypeAdapter, HttpUrl
+
+import app
+
+
+# --- JSON extraction
+def test_find_json_span_ignores_braces_in_strings():
+    s = 'prefix {"a": "}{", "b": {"c": 1}} suffix {"d": 2}'
+    start, end = app._find_json_span(s)
+    assert s[start:end] == '{"a": "}{", "b": {"c": 1}}'
+
+def test_find_json_span_handles_escaped_quotes():
+    s = '{"a": "x\\"}"}'
+    assert app._find_json_span(s) == (0, len(s))
+
+def test_find_json_span_none_without_object():
+    assert app._find_json_span("no json here") is None
+    assert app._find_json_span('{"unterminated": 1') is None
+
+@pytest.mark.parametrize("raw", [
+    '{"allowed": true}',
+    '```json\n{"allowed": true}\n```',
+    'Sure, here it is: {"allowed": true} hope that helps',
+    '"{\\n  \\"allowed\\": true\\n}"',
+    '{&quot;allowed&quot;: true}',
+])
+def test_clean_model_text_and_extract_json(raw):
+    assert app.clean_model_text_and_extract_json(raw) == {"allowed": True}
+
+def test_clean_model_text_and_extract_json_rejects_garbage():
+    with pytest.raises(ValueError):
+        app.clean_model_text_and_extract_json("definitely not json")
+
+
+# --- validation result cache key
+def test_validation_cache_key_fields_cannot_collide():
+    url = TypeAdapter(HttpUrl)
+    a = app.validation_cache_key("a|http://x/", str(url.validate_python("http://y/")), app.PREDEFINED_TAGS)
+    b = app.validation_cache_key("a", str(url.validate_python("http://x/|http://y/")), app.PREDEFINED_TAGS)
+    assert a != b
+
+def test_validation_cache_key_depends_on_every_field():
+    base = app.validation_cache_key("desc", "http://x/", app.PREDEFINED_TAGS)
+    assert base == app.validation_cache_key("desc", "http://x/", app.PREDEFINED_TAGS)
+    assert base != app.validation_cache_key("desc2", "http://x/", app.PREDEFINED_TAGS)
+    assert base != app.validation_cache_key("desc", None, app.PREDEFINED_TAGS)
+    assert base != app.validation_cache_key("desc", "http://x/", app.PREDEFINED_TAGS[:1])
+
+
+# --- Gemini call pacing
+def test_rate_limiter_spaces_calls(monkeypatch):
+    delays = []
+
+    async def fake_sleep(d):
+        delays.append(d)
+
+    monkeypatch.setattr(app.asyncio, "sleep", fake_sleep)
+    limiter = app._RateLimiter(rpm=60)
+
+    async def run():
+        for _ in range(3):
+            await limiter.acquire()
+
+    asyncio.run(run())
+    assert len(delays) == 2
+    assert delays[0] == pytest.approx(1.0, abs=0.05)
+    assert delays[1] == pytest.approx(2.0, abs=0.05)
+
+def test_rate_limiter_disabled_with_zero_rpm(monkeypatch):
+    monkeypatch.setattr(app.asyncio, "sleep", pytest.fail)
+    asyncio.run(app._RateLimiter(rpm=0).acquire())
+
+
+# --- routes
+def test_lifespan_owns_http_client():
+    with TestClient(app.app) as client:
+        assert isinstance(app.HTTP_CLIENT, app.httpx.AsyncClient)
+        r = client.get("/health")
+        assert r.status_code == 200
+        assert r.json()["tag_count"] == len(app.PREDEFINED_TAGS)
+    assert app.HTTP_CLIENT is None
+
+def test_validate_batch_reports_item_errors_in_order(monkeypatch):
+    async def fake_validate_one(req, debug=False):
+        if req.description == "bad":
+            raise HTTPException(status_code=400, detail="Could not fetch image for validation")
+        return {"allowed": True, "reason": None, "flags": {}, "suggestedTags": ["Wifi"]}
+
+    monkeypatch.setattr(app, "GENAI_CONFIGURED", True)
+    monkeypatch.setattr(app, "validate_one", fake_validate_one)
+    with TestClient(app.app) as client:
+        r = client.post("/validate_batch", json=[{"description": "ok"}, {"description": "bad"}])
+    assert r.status_code == 200
+    ok, bad = r.json()
+    assert ok["allowed"] is True and ok["suggestedTags"] == ["Wifi"]
+    assert bad["allowed"] is False
+    assert bad["reason"] == "error: Could not fetch image for validation"
+
+def test_validate_batch_rejects_oversized_batch(monkeypatch):
+    monkeypatch.setattr(app, "GENAI_CONFIGURED", True)
+    monkeypatch.setattr(app, "MAX_BATCH_SIZE", 1)
+    with TestClient(app.app) as client:
+        r = client.post("/validate_batch", json=[{"description": "a"}, {"description": "b"}])
+    assert r.status_code == 413